@@ -5,6 +5,9 @@ import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime, timedelta
 import numpy as np
+import os
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 
 # Configurazione pagina
 st.set_page_config(
@@ -18,19 +21,72 @@ st.set_page_config(
 st.title("📈 Dashboard Analitica Vendite")
 st.markdown("---")
 
+# Tipi a 32 bit: i valori ci stanno e le aggregazioni leggono metà dei byte
+COMPACT_DTYPES = {
+    'sales': 'int32',
+    'customers': 'int32',
+    'profit': 'float32',
+    'margin': 'float32'
+}
+
 # Caricamento dati
-@st.cache_data
-def load_data():
+@st.cache_data(persist="disk")
+def load_data(data_version):
+    # data_version (mtime di data.csv) fa parte della chiave: la cache su disco
+    # sopravvive ai riavvii, quindi senza di esso le modifiche al CSV verrebbero
+    # ignorate. Ogni cache derivata dal frame deve ricevere lo stesso token.
+    df = read_data()
+    # Totale vendite complessivo: non dipende dai filtri, si calcola una volta
+    return df, int(df['sales'].sum())
+
+def read_data():
+    # Il Parquet conserva i dtype: se è più recente del CSV si evita il parsing
+    # Un file danneggiato o incompleto si scarta e si rigenera dal CSV
+    try:
+        if os.path.getmtime('data.parquet') >= os.path.getmtime('data.csv'):
+            return pd.read_parquet('data.parquet', engine='pyarrow')
+    except (OSError, pa.ArrowInvalid):
+        pass
+
     try:
         df = pd.read_csv('data.csv')
-        df['date'] = pd.to_datetime(df['date'])
-        df['margin'] = (df['profit'] / df['sales'] * 100).round(2)
-        return df
     except FileNotFoundError:
         # Se il file non esiste, crea dati di esempio
         st.warning("File data.csv non trovato. Genero dati di esempio...")
         return create_sample_data()
 
+    df = normalize_frame(df)
+
+    # Salva la versione Parquet per i prossimi avvii a freddo; si scrive su un
+    # file temporaneo e lo si rinomina, così non resta mai un file troncato
+    tmp_path = f'data.parquet.{os.getpid()}.tmp'
+    try:
+        df.to_parquet(tmp_path, engine='pyarrow', compression='zstd')
+        os.replace(tmp_path, 'data.parquet')
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+    return df
+
+def normalize_frame(df):
+    # Normalizzazione unica per CSV e dati di esempio: stessi dtype e indice
+    df['date'] = pd.to_datetime(df['date'])
+    df['margin'] = compute_margin(df['profit'].to_numpy(), df['sales'].to_numpy())
+    df = df.astype(COMPACT_DTYPES)
+    for col in ('category', 'product', 'region'):
+        df[col] = df[col].astype('category')
+    # Indice temporale ordinato: il filtro per data diventa una ricerca binaria
+    return df.sort_values('date', kind='stable').set_index('date')
+
+def compute_margin(profit, sales):
+    # Margine % calcolato in un unico buffer; NaN dove le vendite sono zero
+    margin = np.full(profit.shape, np.nan)
+    np.divide(profit, sales, out=margin, where=sales != 0)
+    np.multiply(margin, 100, out=margin)
+    return np.round(margin, 2, out=margin)
+
 def create_sample_data():
     date_range = pd.date_range('2024-01-01', '2024-01-31')
     categories = ['Elettronica', 'Abbigliamento', 'Casa']
@@ -41,38 +97,95 @@ def create_sample_data():
     }
     regions = ['Nord', 'Centro', 'Sud']
     
-    data = []
-    for date in date_range:
-        for category in categories:
-            for product in products[category]:
-                sales = np.random.randint(1000, 20000)
-                profit = sales * np.random.uniform(0.25, 0.35)
-                customers = int(sales / np.random.randint(40, 60))
-                region = np.random.choice(regions)
-                
-                data.append({
-                    'date': date,
-                    'category': category,
-                    'product': product,
-                    'sales': sales,
-                    'profit': profit,
-                    'customers': customers,
-                    'region': region
-                })
-    
-    df = pd.DataFrame(data)
-    df['margin'] = (df['profit'] / df['sales'] * 100).round(2)
-    return df
+    # Colonne costruite direttamente (una riga per data e prodotto)
+    pair_categories = np.repeat(categories, [len(products[c]) for c in categories])
+    pair_products = np.concatenate([products[c] for c in categories])
+    n_pairs = len(pair_products)
+    n = len(date_range) * n_pairs
+
+    # Tutti i valori casuali estratti in blocco, una colonna alla volta;
+    # il seed fisso rende i dati di esempio riproducibili
+    rng = np.random.default_rng(42)
+    sales = rng.integers(1000, 20000, size=n)
+    profit = sales * rng.uniform(0.25, 0.35, size=n)
+    customers = sales // rng.integers(40, 60, size=n)
+    region = rng.choice(regions, size=n)
+
+    df = pd.DataFrame({
+        'date': np.repeat(date_range.values, n_pairs),
+        'category': np.tile(pair_categories, len(date_range)),
+        'product': np.tile(pair_products, len(date_range)),
+        'sales': sales,
+        'profit': profit,
+        'customers': customers,
+        'region': region
+    })
+    return normalize_frame(df)
+
+def daily_totals(frame, columns=('sales', 'profit', 'customers')):
+    # L'indice è ordinato per data: ogni giorno è un blocco contiguo di righe,
+    # quindi basta una reduceat per colonna al posto di groupby('date')
+    dates = frame.index.to_numpy()
+    if len(dates) == 0:
+        return frame[list(columns)]
+    starts = np.flatnonzero(np.r_[True, dates[1:] != dates[:-1]])
+    totals = {}
+    for col in columns:
+        values = frame[col].to_numpy()
+        totals[col] = np.add.reduceat(values, starts, dtype=np.result_type(values, np.int64))
+    return pd.DataFrame(totals, index=pd.DatetimeIndex(dates[starts], name='date'))
+
+@st.cache_data(max_entries=32)
+def apply_filters(_df, data_version, start, end, categories, regions):
+    # _df non viene hashato: la sua versione entra nella chiave con data_version
+    sub = _df.loc[pd.Timestamp(start):pd.Timestamp(end)]
+    return sub[sub['category'].isin(categories) & sub['region'].isin(regions)]
+
+@st.cache_data
+def frame_meta(_df, data_version):
+    # Dipende solo dal frame caricato (data_version), non dai widget; le
+    # categorie sono già note dal dtype categorico, senza scansioni unique()
+    return {
+        'min_date': _df.index.min(),
+        'max_date': _df.index.max(),
+        'categories': _df['category'].cat.categories.tolist(),
+        'regions': _df['region'].cat.categories.tolist()
+    }
+
+@st.cache_data(max_entries=8)
+def to_csv_bytes(_df, data_version, filters):
+    # Il writer CSV di Arrow è in C++ e molto più veloce di DataFrame.to_csv;
+    # la cache è indicizzata da versione dei dati e filtri, _df non viene hashato
+    table = pa.Table.from_pandas(_df, preserve_index=False)
+    table = table.add_column(0, 'date', pa.array(_df.index).cast(pa.date32()))
+    sink = pa.BufferOutputStream()
+    pa_csv.write_csv(table, sink)
+    return sink.getvalue().to_pybytes()
+
+def session_figure(key, build, shape=None):
+    # Lo scheletro della figura resta in session_state e ai rerun si aggiornano
+    # solo i dati; si ricostruisce se cambia la struttura delle tracce (shape)
+    cached = st.session_state.get(key)
+    if cached is None or cached[0] != shape:
+        cached = st.session_state[key] = (shape, build())
+    return cached[1]
 
 # Carica dati
-df = load_data()
+# Versione dei dati: chiave comune a load_data e alle cache che ne derivano
+try:
+    data_version = os.path.getmtime('data.csv')
+except OSError:
+    data_version = None
+df, total_sales_all = load_data(data_version)
+
+meta = frame_meta(df, data_version)
 
 # Sidebar - Filtri
 st.sidebar.header("🔍 Filtri")
 
 # Selettore data
-min_date = df['date'].min()
-max_date = df['date'].max()
+min_date = meta['min_date']
+max_date = meta['max_date']
 date_range = st.sidebar.date_input(
     "Intervallo Date",
     value=(min_date, max_date),
@@ -81,7 +194,7 @@ date_range = st.sidebar.date_input(
 )
 
 # Filtro categoria
-categories = df['category'].unique().tolist()
+categories = meta['categories']
 selected_categories = st.sidebar.multiselect(
     "Categoria",
     options=categories,
@@ -89,7 +202,7 @@ selected_categories = st.sidebar.multiselect(
 )
 
 # Filtro regione
-regions = df['region'].unique().tolist()
+regions = meta['regions']
 selected_regions = st.sidebar.multiselect(
     "Regione",
     options=regions,
@@ -98,24 +211,33 @@ selected_regions = st.sidebar.multiselect(
 
 # Applica filtri
 if len(date_range) == 2:
-    mask = (
-        (df['date'] >= pd.to_datetime(date_range[0])) &
-        (df['date'] <= pd.to_datetime(date_range[1])) &
-        (df['category'].isin(selected_categories)) &
-        (df['region'].isin(selected_regions))
+    filtered_df = apply_filters(
+        df,
+        data_version,
+        date_range[0],
+        date_range[1],
+        tuple(selected_categories),
+        tuple(selected_regions)
     )
-    filtered_df = df[mask].copy()
 else:
-    filtered_df = df.copy()
+    filtered_df = df
 
 # KPI Cards
 st.subheader("📊 Indicatori Chiave (KPI)")
 
 col1, col2, col3, col4 = st.columns(4)
 
+# Riduzioni dei KPI in un solo passaggio; le colonne int32 vengono sommate a
+# 64 bit da pandas, il profitto float32 va accumulato esplicitamente in float64
+kpi = filtered_df.agg({'sales': 'sum', 'customers': 'mean'}).astype('float64')
+total_sales = kpi['sales']
+total_profit = filtered_df['profit'].to_numpy().sum(dtype=np.float64)
+avg_customers = kpi['customers']
+unique_products = filtered_df['product'].nunique()
+n_rows = len(filtered_df)
+
 with col1:
-    total_sales = filtered_df['sales'].sum()
-    delta_sales = ((filtered_df['sales'].sum() / df['sales'].sum()) - 1) * 100
+    delta_sales = ((total_sales / total_sales_all) - 1) * 100
     st.metric(
         label="Vendite Totali",
         value=f"€ {total_sales:,.0f}",
@@ -123,7 +245,6 @@ with col1:
     )
 
 with col2:
-    total_profit = filtered_df['profit'].sum()
     st.metric(
         label="Profitto Totale",
         value=f"€ {total_profit:,.0f}",
@@ -131,7 +252,6 @@ with col2:
     )
 
 with col3:
-    avg_customers = filtered_df['customers'].mean()
     st.metric(
         label="Clienti Medi Giornalieri",
         value=f"{avg_customers:.0f}",
@@ -139,11 +259,10 @@ with col3:
     )
 
 with col4:
-    unique_products = filtered_df['product'].nunique()
     st.metric(
         label="Prodotti Venduti",
         value=unique_products,
-        delta=f"{len(filtered_df)} transazioni"
+        delta=f"{n_rows} transazioni"
     )
 
 st.markdown("---")
@@ -155,36 +274,42 @@ with col_left:
     st.subheader("💰 Andamento Vendite Giornaliero")
     
     # Dati aggregati per giorno
-    daily_sales = filtered_df.groupby('date').agg({
-        'sales': 'sum',
-        'profit': 'sum',
-        'customers': 'sum'
-    }).reset_index()
+    daily_sales = daily_totals(filtered_df)
+    # Con troppi punti si passa a dati settimanali
+    if len(daily_sales) > 500:
+        daily_sales = daily_sales.resample('W').sum()
+    daily_sales = daily_sales.reset_index()
     
-    # Grafico lineare con Plotly
-    fig = px.line(
-        daily_sales,
-        x='date',
-        y='sales',
-        title='Vendite per Data',
-        labels={'sales': 'Vendite (€)', 'date': 'Data'},
-        markers=True
-    )
-    fig.update_layout(hovermode='x unified')
+    # Grafico lineare con Plotly in WebGL (un solo canvas invece di nodi SVG)
+    fig = session_figure('fig_line', lambda: go.Figure(
+        go.Scattergl(mode='lines+markers', name='Vendite'),
+        layout=dict(
+            title='Vendite per Data',
+            xaxis_title='Data',
+            yaxis_title='Vendite (€)',
+            hovermode='x unified'
+        )
+    ))
+    fig.data[0].x = daily_sales['date'].to_numpy()
+    fig.data[0].y = daily_sales['sales'].to_numpy()
     st.plotly_chart(fig, use_container_width=True)
 
 with col_right:
     st.subheader("🏷️ Vendite per Categoria")
     
-    category_sales = filtered_df.groupby('category')['sales'].sum().reset_index()
+    category_sales = filtered_df.groupby('category', observed=True)['sales'].sum().reset_index()
+    # px raggruppa con observed=False: i livelli senza righe vanno rimossi
+    category_sales['category'] = category_sales['category'].cat.remove_unused_categories()
     
-    fig_pie = px.pie(
+    fig_pie = session_figure('fig_pie', lambda: px.pie(
         category_sales,
         values='sales',
         names='category',
         hole=0.4,
         title='Distribuzione per Categoria'
-    )
+    ))
+    fig_pie.data[0].labels = category_sales['category'].astype(str).to_numpy()
+    fig_pie.data[0].values = category_sales['sales'].to_numpy()
     st.plotly_chart(fig_pie, use_container_width=True)
 
 # Seconda riga di grafici
@@ -192,14 +317,19 @@ st.subheader("📈 Analisi Dettagliata")
 
 tab1, tab2, tab3 = st.tabs(["Per Regione", "Top Prodotti", "Margini"])
 
+# Le schede vengono renderizzate tutte a ogni rerun: aggregati calcolati una volta
+by_region = filtered_df.groupby('region', observed=True)[['sales', 'profit', 'customers']].sum()
+product_groups = filtered_df.groupby('product', observed=True)
+by_product = product_groups[['sales', 'profit']].sum().join(product_groups['margin'].mean())
+
 with tab1:
-    region_sales = filtered_df.groupby('region').agg({
-        'sales': 'sum',
-        'profit': 'sum',
-        'customers': 'sum'
-    }).reset_index()
+    region_sales = by_region.reset_index()
+    # px raggruppa color= con observed=False: i livelli senza righe vanno rimossi
+    region_sales['region'] = region_sales['region'].cat.remove_unused_categories()
     
-    fig_bar = px.bar(
+    # Una traccia per regione: la figura va ricostruita se cambiano le regioni
+    region_totals = dict(zip(region_sales['region'].astype(str), region_sales['sales']))
+    fig_bar = session_figure('fig_bar', lambda: px.bar(
         region_sales,
         x='region',
         y='sales',
@@ -207,17 +337,18 @@ with tab1:
         title='Vendite per Regione',
         labels={'sales': 'Vendite (€)', 'region': 'Regione'},
         text='sales'
+    ).update_traces(texttemplate='€%{text:,.0f}', textposition='outside'),
+        shape=tuple(sorted(region_totals))
     )
-    fig_bar.update_traces(texttemplate='€%{text:,.0f}', textposition='outside')
+    for trace in fig_bar.data:
+        trace.y = [region_totals[trace.name]]
+        trace.text = [region_totals[trace.name]]
     st.plotly_chart(fig_bar, use_container_width=True)
 
 with tab2:
-    top_products = filtered_df.groupby('product').agg({
-        'sales': 'sum',
-        'profit': 'sum'
-    }).nlargest(10, 'sales').reset_index()
+    top_products = by_product.nlargest(10, 'sales').reset_index()
     
-    fig_bar_h = px.bar(
+    fig_bar_h = session_figure('fig_bar_h', lambda: px.bar(
         top_products,
         y='product',
         x='sales',
@@ -226,16 +357,16 @@ with tab2:
         labels={'sales': 'Vendite (€)', 'product': 'Prodotto'},
         color='sales',
         color_continuous_scale='Viridis'
-    )
+    ))
+    fig_bar_h.data[0].x = top_products['sales'].to_numpy()
+    fig_bar_h.data[0].y = top_products['product'].astype(str).to_numpy()
+    fig_bar_h.data[0].marker.color = top_products['sales'].to_numpy()
     st.plotly_chart(fig_bar_h, use_container_width=True)
 
 with tab3:
-    product_margin = filtered_df.groupby('product').agg({
-        'sales': 'sum',
-        'margin': 'mean'
-    }).reset_index()
+    product_margin = by_product.reset_index()
     
-    fig_scatter = px.scatter(
+    fig_scatter = session_figure('fig_scatter', lambda: px.scatter(
         product_margin,
         x='sales',
         y='margin',
@@ -245,7 +376,15 @@ with tab3:
         title='Margine vs Vendite per Prodotto',
         labels={'sales': 'Vendite (€)', 'margin': 'Margine %'},
         color_continuous_scale='RdYlGn'
-    )
+    ))
+    scatter = fig_scatter.data[0]
+    scatter.x = product_margin['sales'].to_numpy()
+    scatter.y = product_margin['margin'].to_numpy()
+    scatter.hovertext = product_margin['product'].astype(str).to_numpy()
+    scatter.marker.size = product_margin['sales'].to_numpy()
+    scatter.marker.color = product_margin['margin'].to_numpy()
+    # Stessa scala delle bolle di px.scatter (size_max=20)
+    scatter.marker.sizeref = 2.0 * product_margin['sales'].max() / 20 ** 2
     st.plotly_chart(fig_scatter, use_container_width=True)
 
 # Tabella dati
@@ -259,19 +398,21 @@ view_option = st.radio(
 )
 
 if view_option == "Sintesi":
-    summary_df = filtered_df.groupby(['date', 'category', 'region']).agg({
-        'sales': 'sum',
-        'profit': 'sum',
-        'customers': 'sum',
-        'margin': 'mean'
-    }).reset_index()
+    summary_groups = filtered_df.groupby(['date', 'category', 'region'], observed=True)
+    summary_df = (
+        summary_groups[['sales', 'profit', 'customers']].sum()
+        .join(summary_groups['margin'].mean())
+        .reset_index()
+    )
+    # groupby restituisce le chiavi già ordinate per data: basta invertire
     st.dataframe(
-        summary_df.sort_values('date', ascending=False),
+        summary_df[::-1],
         use_container_width=True
     )
 else:
+    # filtered_df eredita l'ordinamento per data di load_data
     st.dataframe(
-        filtered_df.sort_values('date', ascending=False),
+        filtered_df[::-1],
         use_container_width=True
     )
 
@@ -280,7 +421,11 @@ st.sidebar.markdown("---")
 st.sidebar.subheader("📥 Esporta Dati")
 
 if st.sidebar.button("Scarica CSV Filtrato"):
-    csv = filtered_df.to_csv(index=False)
+    csv = to_csv_bytes(
+        filtered_df,
+        data_version,
+        (tuple(date_range), tuple(selected_categories), tuple(selected_regions))
+    )
     st.sidebar.download_button(
         label="Download CSV",
         data=csv,
@@ -299,8 +444,8 @@ st.sidebar.info(
     """.format(
         max_date.strftime('%d/%m/%Y'),
         len(filtered_df),
-        filtered_df['date'].min().strftime('%d/%m'),
-        filtered_df['date'].max().strftime('%d/%m')
+        filtered_df.index.min().strftime('%d/%m'),
+        filtered_df.index.max().strftime('%d/%m')
     )
 )
 